@@ -1,3 +1,8 @@
+import copy
+import itertools
+import os
+import os.path as osp
+
 from mim.utils import exit_with_error
 
 try:
@@ -30,15 +35,13 @@ class SEBlock(nn.Module):
                             kernel_size=1,
                             stride=1,
                             bias=True)
-        self.input_channels = input_channels
 
     def forward(self, inputs):
-        x = F.avg_pool2d(inputs, kernel_size=inputs.size(3))
+        x = inputs.mean(dim=(2, 3), keepdim=True)
         x = self.down(x)
         x = F.relu(x)
         x = self.up(x)
         x = torch.sigmoid(x)
-        x = x.view(-1, self.input_channels, 1, 1)
         return inputs * x
 
 
@@ -59,6 +62,10 @@ def conv_bn(in_channels, out_channels, kernel_size, stride, padding, groups=1):
     return result
 
 
+def _check_input(module, inputs):
+    assert inputs[0].shape[1] == 3, "first input channel equal 3"
+
+
 class RepVGGBlock(nn.Module):
     """RepVGG BLock Module
     Args:
@@ -66,6 +73,8 @@ class RepVGGBlock(nn.Module):
         out_channels: output channels
         kernel_size: kernel size 
         use_se: use SEBlock or not
+        deploy: build only the re-parameterized conv (rbr_reparam), for
+            loading a checkpoint saved by RepVGG.save_deploy
     """
     def __init__(self,
                  in_channels,
@@ -76,13 +85,24 @@ class RepVGGBlock(nn.Module):
                  dilation=1,
                  groups=1,
                  padding_mode='zeros',
-                 use_se=False):
+                 use_se=False,
+                 deploy=False):
 
         super(RepVGGBlock, self).__init__()
         assert kernel_size == 3, "kernel size only 33 or 11"
         assert padding == 1, "this padding to keep the input feature map \
                                         size equal to the output size"
 
+        self.deploy = deploy
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.padding = padding
+        self.dilation = dilation
+        self.groups = groups
+        self.padding_mode = padding_mode
+
         padding11 = padding - kernel_size // 2
 
         if use_se:
@@ -93,8 +113,16 @@ class RepVGGBlock(nn.Module):
 
         self.nonlinearity = nn.ReLU()
 
+        self._has_id = out_channels == in_channels and stride == 1
+        # fused (kernel, bias) used by no_grad eval forwards, dropped by
+        # train(), _apply() and _load_from_state_dict()
+        self._eval_kernel_bias = None
+        if deploy:
+            self.rbr_reparam = self._reparam_conv()
+            return
+
         self.rbr_identity = nn.BatchNorm2d(num_features=in_channels) \
-                            if out_channels == in_channels and stride == 1 else None
+                            if self._has_id else None
 
         self.rbr_dense = conv_bn(in_channels=in_channels,
                                  out_channels=out_channels,
@@ -110,13 +138,145 @@ class RepVGGBlock(nn.Module):
                                groups=groups)
 
     def forward(self, inputs):
-        if self.rbr_identity is None:
-            id_out = 0
-        else:
-            id_out = self.rbr_identity(inputs)
+        if self.deploy:
+            return self.nonlinearity(self.se(self.rbr_reparam(inputs)))
+
+        if not self.training and not torch.is_grad_enabled():
+            kernel, bias = self._get_eval_kernel_bias()
+            out = F.conv2d(inputs, kernel, bias, self.stride, self.padding,
+                           self.dilation, self.groups)
+            return self.nonlinearity(self.se(out))
+
+        # every branch output is freshly allocated, accumulate in place
+        out = self.rbr_dense(inputs)
+        out.add_(self.rbr_1x1(inputs))
+        if self._has_id:
+            out.add_(self.rbr_identity(inputs))
+        return self.nonlinearity(self.se(out))
+
+    def _fuse_bn(self, kernel, bn):
+        """fold bn into the preceding kernel, returns the equivalent (kernel, bias)
+        """
+        t = bn.weight / (bn.running_var + bn.eps).sqrt()
+        return kernel * t.reshape(-1, 1, 1, 1), bn.bias - bn.running_mean * t
+
+    def _pad_1x1_to_3x3(self, kernel):
+        return F.pad(kernel, [1, 1, 1, 1])
+
+    def _identity_kernel(self):
+        """identity branch written as a 3x3 conv kernel
+        """
+        input_dim = self.in_channels // self.groups
+        weight = self.rbr_identity.weight
+        kernel = torch.zeros(self.in_channels,
+                             input_dim,
+                             3,
+                             3,
+                             dtype=weight.dtype,
+                             device=weight.device)
+        for i in range(self.in_channels):
+            kernel[i, i % input_dim, 1, 1] = 1
+        return kernel
+
+    def _get_eq_kernel_bias(self):
+        """sum the three branches into a single 3x3 (kernel, bias)
+        """
+        kernel3x3, bias3x3 = self._fuse_bn(self.rbr_dense.conv.weight,
+                                           self.rbr_dense.bn)
+        kernel1x1, bias1x1 = self._fuse_bn(self.rbr_1x1.conv.weight,
+                                           self.rbr_1x1.bn)
+        kernel = kernel3x3 + self._pad_1x1_to_3x3(kernel1x1)
+        bias = bias3x3 + bias1x1
+        if self._has_id:
+            kernel_id, bias_id = self._fuse_bn(self._identity_kernel(),
+                                               self.rbr_identity)
+            kernel = kernel + kernel_id
+            bias = bias + bias_id
+        return kernel, bias
+
+    @torch.no_grad()
+    def _get_eval_kernel_bias(self):
+        if self._eval_kernel_bias is None:
+            kernel, bias = self._get_eq_kernel_bias()
+            self._eval_kernel_bias = (
+                kernel.contiguous(memory_format=torch.channels_last), bias)
+        return self._eval_kernel_bias
+
+    def _reparam_conv(self):
+        return nn.Conv2d(in_channels=self.in_channels,
+                         out_channels=self.out_channels,
+                         kernel_size=self.kernel_size,
+                         stride=self.stride,
+                         padding=self.padding,
+                         dilation=self.dilation,
+                         groups=self.groups,
+                         bias=True,
+                         padding_mode=self.padding_mode)
+
+    def train(self, mode=True):
+        # the bn statistics may change from here on, refold on the next eval
+        self._eval_kernel_bias = None
+        return super(RepVGGBlock, self).train(mode)
+
+    def _apply(self, *args, **kwargs):
+        # .to() / .cuda() / .half() ... change the device or dtype of the weights
+        self._eval_kernel_bias = None
+        return super(RepVGGBlock, self)._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._eval_kernel_bias = None
+        return super(RepVGGBlock, self)._load_from_state_dict(*args, **kwargs)
+
+    @torch.no_grad()
+    def switch_to_deploy(self):
+        """re-parameterize the three branches into one 3x3 conv (rbr_reparam)
+        for inference, this can not be undone
+        """
+        if self.deploy:
+            return
+        kernel, bias = self._get_eq_kernel_bias()
+        self.rbr_reparam = self._reparam_conv()
+        self.rbr_reparam.weight.data = kernel
+        self.rbr_reparam.bias.data = bias
+        del self.rbr_dense
+        del self.rbr_1x1
+        del self.rbr_identity
+        self._eval_kernel_bias = None
+        self.deploy = True
+
+
+class RepVGGPackedBlocks(nn.Module):
+    """Consecutive deployed RepVGGBlocks of one shape, their kernels are stacked
+    in a single (num_blocks, out_channels, 3, 3, in_channels/groups) buffer so
+    weight[i].permute(0, 3, 1, 2) is a channels_last kernel view of block i
+    Args:
+        blocks: deployed RepVGGBlocks, stride 1, in_channels == out_channels
+            and the same groups
+    """
+    def __init__(self, blocks):
+        super(RepVGGPackedBlocks, self).__init__()
+        self.groups = blocks[0].groups
+        self.padding = blocks[0].padding
+        self.weight = nn.Parameter(
+            torch.stack([
+                b.rbr_reparam.weight.detach().permute(0, 2, 3, 1)
+                for b in blocks
+            ]).contiguous())
+        self.bias = nn.Parameter(
+            torch.stack([b.rbr_reparam.bias.detach() for b in blocks]))
+        self.se = nn.ModuleList([b.se for b in blocks])
+        self.nonlinearity = blocks[0].nonlinearity
 
-        return self.nonlinearity(
-            self.se(self.rbr_dense(inputs) + self.rbr_1x1(inputs) + id_out))
+    def forward(self, inputs):
+        out = inputs
+        for i, se in enumerate(self.se):
+            out = F.conv2d(out,
+                           self.weight[i].permute(0, 3, 1, 2),
+                           self.bias[i],
+                           padding=self.padding,
+                           groups=self.groups)
+            out = self.nonlinearity(se(out))
+        return out
 
 
 @BACKBONES.register_module()
@@ -132,15 +292,33 @@ class RepVGG(nn.Module):
     Args:
         num_blocks: Depth of RepVGG, from [4, 6, 16, 1] .
         width_multiplier : stage width  ,from [2.5, 2.5, 2.5, 5] ,default None
-        override_groups_map:.... ,default None
+        override_groups_map: dict of layer index -> groups, or a set of the
+            layer indices using 4 groups ,default None
         use_se: use SEBlock or not ,default False
+        compile_cfg: kwargs of torch.compile, e.g. dict(backend='inductor',
+            mode='max-autotune', fullgraph=True), the backbone is compiled
+            in place when given ,default None
+        amp_dtype: run forward under torch.autocast with this dtype, e.g.
+            'bfloat16' (no loss scaling needed), the output is cast back to
+            float32 ,default None
+        allow_tf32: let cuda matmul and cudnn conv use TF32 tensor cores for
+            the float32 kernels. This is a global, one-way switch: True sets
+            torch.backends.cuda.matmul.allow_tf32 and
+            torch.backends.cudnn.allow_tf32 for the whole process and they
+            are never reset, False leaves both flags untouched ,default False
+        deploy: build the re-parameterized blocks directly, for loading a
+            checkpoint saved by save_deploy ,default False
     """
     def __init__(self,
                  num_blocks,
                  num_classes,
                  use_se=False,
                  width_multiplier=None,
-                 override_groups_map=None):
+                 override_groups_map=None,
+                 compile_cfg=None,
+                 amp_dtype=None,
+                 allow_tf32=False,
+                 deploy=False):
 
         super(RepVGG, self).__init__()
         assert len(width_multiplier) == 4, " "
@@ -148,6 +326,12 @@ class RepVGG(nn.Module):
         assert 0 not in self.override_groups_map, " "
 
         self.use_se = use_se
+        self.deploy = deploy
+        self.amp_dtype = getattr(torch, amp_dtype) \
+                         if isinstance(amp_dtype, str) else amp_dtype
+        if allow_tf32:
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
         self.cur_layer_idx = 1
         self.in_planes = min(64, int(64 * width_multiplier[0]))
         self.stage0 = RepVGGBlock(in_channels=3,
@@ -155,7 +339,8 @@ class RepVGG(nn.Module):
                                   kernel_size=3,
                                   stride=2,
                                   padding=1,
-                                  use_se=self.use_se)
+                                  use_se=self.use_se,
+                                  deploy=self.deploy)
 
         self.stage1 = self._make_stage(int(64 * width_multiplier[0]),
                                        num_blocks[0],
@@ -171,27 +356,253 @@ class RepVGG(nn.Module):
                                        stride=2)
         self.gap = nn.AdaptiveAvgPool2d(output_size=1)
         self.linear = nn.Linear(int(512 * width_multiplier[3]), num_classes)
+        # replaced by quant/dequant stubs in quantize_int8()
+        self.quant = nn.Identity()
+        self.dequant = nn.Identity()
+        if os.environ.get('REPVGG_DEBUG'):
+            self.register_forward_pre_hook(_check_input)
+        # NHWC lets cudnn/onednn dispatch their fast conv kernels directly
+        self.to(memory_format=torch.channels_last)
+        if compile_cfg is not None:
+            # inductor fuses the branch adds, bn and relu of every block
+            self.compile(**compile_cfg)
+
+    def _layer_groups(self, layer_idx):
+        if isinstance(self.override_groups_map, dict):
+            return self.override_groups_map.get(layer_idx, 1)
+        return 4 if layer_idx in self.override_groups_map else 1
 
     def _make_stage(self, planes, num_blocks, stride):
         strides = [stride] + [1] * (num_blocks - 1)
-        blocks = []
-        for stride in strides:
-            cur_groups = self.override_groups_map.get(self.cur_layer_idx, 1)
-            blocks.append(
-                RepVGGBlock(in_channels=self.in_planes,
-                            out_channels=planes,
-                            kernel_size=3,
-                            stride=stride,
-                            padding=1,
-                            groups=cur_groups,
-                            use_se=self.use_se))
-            self.in_planes = planes
-            self.cur_layer_idx += 1
+        start = self.cur_layer_idx
+        blocks = [
+            RepVGGBlock(in_channels=self.in_planes if i == 0 else planes,
+                        out_channels=planes,
+                        kernel_size=3,
+                        stride=s,
+                        padding=1,
+                        groups=self._layer_groups(start + i),
+                        use_se=self.use_se,
+                        deploy=self.deploy) for i, s in enumerate(strides)
+        ]
+        self.in_planes = planes
+        self.cur_layer_idx = start + len(strides)
         return nn.Sequential(*blocks)
 
+    def switch_to_deploy(self):
+        """convert every RepVGGBlock to its single-conv inference form
+        """
+        for m in self.modules():
+            if isinstance(m, RepVGGBlock):
+                m.switch_to_deploy()
+                m.to(memory_format=torch.channels_last)
+
+    def save_deploy(self, path):
+        """save the state dict of a re-parameterized copy of the model, load it
+        into RepVGG(..., deploy=True) to skip switch_to_deploy at start up
+        Args:
+            path: checkpoint file
+        """
+        model = copy.deepcopy(self)
+        model.switch_to_deploy()
+        torch.save(model.state_dict(), path)
+
+    def pack_stages(self):
+        """switch to deploy, then replace every run of adjacent same-shape
+        blocks of a stage by one RepVGGPackedBlocks, inference only, the
+        state dict of a packed model is not compatible with the deploy one.
+        Only dense models (e.g. B3) are packed: with a g4 override_groups_map
+        the groups alternate on every layer, so no two adjacent blocks match
+        and the g4 models are left unchanged
+        """
+        self.switch_to_deploy()
+
+        def pack_key(block):
+            if isinstance(block, RepVGGBlock) and block.stride == 1 and \
+                    block.in_channels == block.out_channels:
+                return 'groups', block.groups
+            return 'single', id(block)
+
+        for name in ['stage1', 'stage2', 'stage3', 'stage4']:
+            modules = []
+            for _, run in itertools.groupby(getattr(self, name), key=pack_key):
+                run = list(run)
+                if len(run) > 1:
+                    modules.append(RepVGGPackedBlocks(run))
+                else:
+                    modules.extend(run)
+            setattr(self, name, nn.Sequential(*modules))
+
+    @torch.no_grad()
+    def warmup(self, shape, iters=10):
+        """run dummy forwards in eval mode, with torch.backends.cudnn.benchmark
+        set this tunes and caches the conv algorithms of the input shape
+        before timing or capture_graph
+        Args:
+            shape: input shape, e.g. (16, 3, 32, 32)
+            iters: forward passes ,default 10
+        """
+        device = next(self.parameters()).device
+        x = torch.zeros(shape, device=device).contiguous(
+            memory_format=torch.channels_last)
+        training = self.training
+        self.eval()
+        for _ in range(iters):
+            self(x)
+        if training:
+            self.train()
+
+    @torch.no_grad()
+    def capture_graph(self, batch_shape, warmup_iters=3):
+        """put the model in eval mode, switch it to deploy (this can not be
+        undone) and capture the inference forward of a fixed input shape in a
+        CUDA graph
+        Example:
+            run = model.capture_graph((16, 3, 32, 32))
+            out = run(imgs)
+        Args:
+            batch_shape: input shape, every replay must use the same shape
+            warmup_iters: forward passes run before capture ,default 3
+        Returns:
+            a callable that copies its input into the static buffer, replays
+            the graph and returns the static output (overwritten by the next
+            replay, clone it to keep it)
+        """
+        # a train mode graph would normalize with batch statistics and update
+        # the bn running stats on every replay
+        self.eval()
+        # the graph must read parameters, not the eval fold cache which is
+        # freed by the next eval() / to() / load_state_dict()
+        self.switch_to_deploy()
+        device = next(self.parameters()).device
+        static_input = torch.zeros(batch_shape, device=device).contiguous(
+            memory_format=torch.channels_last)
+
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            self.warmup(batch_shape, warmup_iters)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_output = self(static_input)
+
+        def replay(x):
+            static_input.copy_(x)
+            graph.replay()
+            return static_output
+
+        return replay
+
+    @torch.no_grad()
+    def export_trt(self, path, batch_size=16, input_size=32, fp16=True):
+        """export a re-parameterized copy of the model to ONNX and build a
+        TensorRT engine from it, the model itself is left unchanged
+        Args:
+            path: engine file, the ONNX graph is saved next to it as .onnx
+            batch_size: static batch size of the engine ,default 16
+            input_size: static input height and width ,default 32
+            fp16: allow FP16 tensor core kernels ,default True
+        Returns:
+            path of the ONNX file
+        """
+        try:
+            import tensorrt as trt
+        except ImportError:
+            raise ImportError('Please install tensorrt to build the engine.')
+
+        model = copy.deepcopy(self)
+        model.eval()
+        model.switch_to_deploy()
+        # precision is chosen by the engine, do not trace autocast casts
+        model.amp_dtype = None
+        device = next(model.parameters()).device
+        onnx_path = osp.splitext(path)[0] + '.onnx'
+        dummy = torch.randn(batch_size, 3, input_size, input_size,
+                            device=device)
+        torch.onnx.export(model,
+                          dummy,
+                          onnx_path,
+                          opset_version=17,
+                          input_names=['x'],
+                          output_names=['logits'],
+                          dynamic_axes=None)
+
+        logger = trt.Logger(trt.Logger.WARNING)
+        builder = trt.Builder(logger)
+        network = builder.create_network(
+            1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+        parser = trt.OnnxParser(network, logger)
+        with open(onnx_path, 'rb') as f:
+            if not parser.parse(f.read()):
+                errors = [
+                    str(parser.get_error(i)) for i in range(parser.num_errors)
+                ]
+                raise RuntimeError('failed to parse {}: {}'.format(
+                    onnx_path, '; '.join(errors)))
+        config = builder.create_builder_config()
+        if fp16:
+            config.set_flag(trt.BuilderFlag.FP16)
+        engine = builder.build_serialized_network(network, config)
+        if engine is None:
+            raise RuntimeError('failed to build the TensorRT engine')
+        with open(path, 'wb') as f:
+            f.write(engine)
+        return onnx_path
+
+    @torch.no_grad()
+    def quantize_int8(self, calib_loader, num_batches=100, backend='fbgemm'):
+        """post-training int8 quantization of the deploy model on cpu
+        Args:
+            calib_loader: yields dict(img=...) like the mmcls loaders, or image
+                tensors, used to calibrate the activation observers
+            num_batches: calibration batches ,default 100
+            backend: quantized engine, 'fbgemm' for x86 'qnnpack' for arm
+        """
+        try:
+            from torch.ao import quantization
+        except ImportError:
+            from torch import quantization
+
+        assert not self.use_se, "SEBlock is not supported by quantize_int8"
+        self.cpu().eval()
+        self.switch_to_deploy()
+        self.amp_dtype = None
+        for m in self.modules():
+            if isinstance(m, RepVGGBlock):
+                quantization.fuse_modules(m, [['rbr_reparam', 'nonlinearity']],
+                                          inplace=True)
+
+        self.quant = quantization.QuantStub()
+        self.dequant = quantization.DeQuantStub()
+        torch.backends.quantized.engine = backend
+        self.qconfig = quantization.get_default_qconfig(backend)
+        quantization.prepare(self, inplace=True)
+        for i, batch in enumerate(calib_loader):
+            if i >= num_batches:
+                break
+            if isinstance(batch, dict):
+                batch = batch['img']
+            elif isinstance(batch, (list, tuple)):
+                batch = batch[0]
+            self(batch)
+        quantization.convert(self, inplace=True)
+        return self
+
     def forward(self, x):
-        assert x.shape[1] == 3, "first input channel equal 3"
-        out = self.stage0(x)
+        if self.amp_dtype is None:
+            return self._forward(x)
+        with torch.autocast(device_type=x.device.type, dtype=self.amp_dtype):
+            out = self._forward(x)
+        return out.float()
+
+    def _forward(self, x):
+        # the only layout change in the network, a 3-channel input is cheap to
+        # transpose and stage0 would otherwise do it once per branch conv
+        x = x.contiguous(memory_format=torch.channels_last)
+        out = self.quant(x)
+        out = self.stage0(out)
         out = self.stage1(out)
         out = self.stage2(out)
         out = self.stage3(out)
@@ -199,4 +610,5 @@ class RepVGG(nn.Module):
         out = self.gap(out)
         out = out.view(out.size(0), -1)
         out = self.linear(out)
+        out = self.dequant(out)
         return out
@@ -73,6 +73,8 @@ log_config = dict(
     ])
 # yapf:enable
 
+# let cudnn tune and cache the conv algorithm of every fixed input shape
+cudnn_benchmark = True
 dist_params = dict(backend='nccl')
 log_level = 'INFO'
 load_from = None
@@ -1,18 +1,18 @@
 """
 B3g4 
 RepVGG(num_blocks=[4, 6, 16, 1], 
-                width_multiplier=[3, 3, 3, 5], override_groups_map=g4_map)
+                width_multiplier=[3, 3, 3, 5], override_groups_map=g4_set)
 
 """
 
-g4_map = {l: 4 for l in [2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24, 26]}
+g4_set = frozenset({2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24, 26})
 
 model = dict(type='ImageClassifier',
              backbone=dict(type='RepVGG',
                            num_classes=1000,
                            num_blocks=[4, 6, 16, 1],
                            width_multiplier=[3, 3, 3, 5],
-                           override_groups_map=g4_map),
+                           override_groups_map=g4_set),
              neck=None,
              head=dict(type='ClsHead',
                        loss=dict(type='CrossEntropyLoss', loss_weight=1.0),
@@ -76,6 +76,8 @@ log_config = dict(
     ])
 # yapf:enable
 
+# let cudnn tune and cache the conv algorithm of every fixed input shape
+cudnn_benchmark = True
 dist_params = dict(backend='nccl')
 log_level = 'INFO'
 load_from = None
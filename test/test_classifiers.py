@@ -1,6 +1,16 @@
+import tempfile
+from pathlib import Path
+
+import pytest
 import torch
+from mmcls.models import build_backbone
 from mmcls.models.classifiers import ImageClassifier
 
+SMALL_CFG = dict(type='RepVGG',
+                 num_classes=10,
+                 num_blocks=[2, 2, 2, 1],
+                 width_multiplier=[0.5, 0.5, 0.5, 0.5])
+
 
 def test_repvgg():
     g4_map = {l: 4 for l in [2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24, 26]}
@@ -23,5 +33,188 @@ def test_repvgg():
     assert losses['loss'].item() > 0, "====> loss error "
 
 
+def _trained_backbone(**cfg):
+    """a small RepVGG in eval mode whose bn layers have non-trivial statistics
+    """
+    model = build_backbone(dict(SMALL_CFG, **cfg))
+    model.train()
+    for _ in range(3):
+        model(torch.randn(16, 3, 32, 32))
+    model.eval()
+    return model
+
+
+def test_repvgg_switch_to_deploy():
+    g4_set = frozenset({2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24, 26})
+    model = _trained_backbone(override_groups_map=g4_set)
+    imgs = torch.randn(16, 3, 32, 32)
+    # with grad enabled the eval forward still runs the three branches
+    out = model(imgs).detach()
+    with torch.no_grad():
+        out_fold = model(imgs)
+        model.switch_to_deploy()
+        out_deploy = model(imgs)
+    assert torch.allclose(out, out_fold, atol=1e-4), "====> eval fold error "
+    assert torch.allclose(out, out_deploy, atol=1e-4), "====> deploy error "
+
+
+def test_repvgg_inplace_add_backward():
+    model = build_backbone(SMALL_CFG)
+    model.train()
+    # stride 1 and in == out, so all three branches are summed
+    block = model.stage1[1]
+    imgs = torch.randn(16, block.in_channels, 8, 8).contiguous(
+        memory_format=torch.channels_last)
+    params = [
+        block.rbr_dense.conv.weight, block.rbr_1x1.conv.weight,
+        block.rbr_identity.weight
+    ]
+
+    x = imgs.clone().requires_grad_()
+    out = block(x)
+    out.sum().backward()
+    grads = [p.grad.clone() for p in params] + [x.grad]
+
+    block.zero_grad()
+    x_ref = imgs.clone().requires_grad_()
+    out_ref = block.nonlinearity(
+        block.se(
+            block.rbr_dense(x_ref) + block.rbr_1x1(x_ref) +
+            block.rbr_identity(x_ref)))
+    out_ref.sum().backward()
+    grads_ref = [p.grad for p in params] + [x_ref.grad]
+
+    assert torch.allclose(out, out_ref, atol=1e-5), "====> add_ error "
+    for grad, grad_ref in zip(grads, grads_ref):
+        assert torch.allclose(grad, grad_ref, atol=1e-5), "====> grad error "
+
+
+def test_repvgg_eval_fold_refresh():
+    model = build_backbone(SMALL_CFG)
+    other = _trained_backbone()
+    model.eval()
+    imgs = torch.randn(16, 3, 32, 32)
+    with torch.no_grad():
+        out = model(imgs)
+        # loading new weights in eval mode must refold the cached kernels
+        model.load_state_dict(other.state_dict())
+        out_loaded = model(imgs)
+        out_other = other(imgs)
+        # so must a dtype change after a cached forward
+        out_double = model.double()(imgs.double())
+    assert not torch.allclose(out, out_loaded), "====> stale fold error "
+    assert torch.allclose(out_loaded, out_other, atol=1e-5), "====> fold error "
+    assert out_double.dtype == torch.float64
+    assert torch.allclose(out_double.float(), out_other,
+                          atol=1e-4), "====> fold error "
+
+
+def test_repvgg_compile():
+    compile_cfg = dict(backend='aot_eager', fullgraph=True)
+    model = build_backbone(dict(SMALL_CFG, compile_cfg=compile_cfg))
+    model.train()
+    # fullgraph raises on any graph break from the deploy / identity branches
+    model(torch.randn(16, 3, 32, 32)).sum().backward()
+    assert model.stage1[1].rbr_dense.conv.weight.grad is not None
+    model.eval()
+    eager = build_backbone(SMALL_CFG)
+    eager.load_state_dict(model.state_dict())
+    eager.eval()
+    imgs = torch.randn(16, 3, 32, 32)
+    with torch.no_grad():
+        out = model(imgs)
+        out_eager = eager(imgs)
+    assert torch.allclose(out, out_eager, atol=1e-4), "====> compile error "
+
+
+def test_repvgg_amp_bfloat16():
+    model = _trained_backbone()
+    amp_model = build_backbone(dict(SMALL_CFG, amp_dtype='bfloat16'))
+    amp_model.load_state_dict(model.state_dict())
+    amp_model.train()
+    out_train = amp_model(torch.randn(16, 3, 32, 32))
+    assert out_train.dtype == torch.float32, "====> amp dtype error "
+    out_train.sum().backward()
+    model.load_state_dict(amp_model.state_dict())
+    amp_model.eval()
+    imgs = torch.randn(16, 3, 32, 32)
+    with torch.no_grad():
+        out = model(imgs)
+        out_amp = amp_model(imgs)
+    assert out_amp.dtype == torch.float32, "====> amp dtype error "
+    err = (out_amp - out).abs().max()
+    assert err < 0.05 * out.abs().max(), "====> amp error "
+
+
+def test_repvgg_pack_stages():
+    model = _trained_backbone(num_blocks=[3, 4, 4, 1])
+    imgs = torch.randn(16, 3, 32, 32)
+    with torch.no_grad():
+        model.switch_to_deploy()
+        out_deploy = model(imgs)
+        model.pack_stages()
+        out_packed = model(imgs)
+    # every stage ends with its stride 1 blocks packed into one module
+    assert len(model.stage2) == 2, "====> pack error "
+    assert torch.allclose(out_deploy, out_packed, atol=1e-5), "====> pack error "
+
+
+def test_repvgg_quantize_int8():
+    if 'fbgemm' not in torch.backends.quantized.supported_engines:
+        pytest.skip('fbgemm quantized engine is not available')
+    model = _trained_backbone()
+    model.switch_to_deploy()
+    imgs = torch.randn(16, 3, 32, 32)
+    with torch.no_grad():
+        out = model(imgs)
+    calib_loader = [dict(img=torch.randn(16, 3, 32, 32)) for _ in range(4)]
+    model.quantize_int8(calib_loader)
+    with torch.no_grad():
+        out_int8 = model(imgs)
+    assert out_int8.dtype == torch.float32
+    err = (out_int8 - out).abs().max()
+    assert err < 0.1 * out.abs().max(), "====> int8 error "
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='requires CUDA')
+def test_repvgg_capture_graph():
+    model = _trained_backbone().cuda()
+    run = model.capture_graph((16, 3, 32, 32))
+    # mmcls calls eval() before every test pass, the graph must stay valid
+    model.eval()
+    imgs = torch.randn(16, 3, 32, 32).cuda()
+    with torch.no_grad():
+        out = model(imgs)
+    out_graph = run(imgs).clone()
+    assert torch.allclose(out, out_graph, atol=1e-4), "====> graph error "
+
+
+def test_repvgg_save_deploy(tmp_path):
+    model = _trained_backbone()
+    path = str(tmp_path / 'repvgg_deploy.pth')
+    model.save_deploy(path)
+
+    deploy_model = build_backbone(dict(SMALL_CFG, deploy=True))
+    deploy_model.load_state_dict(torch.load(path))
+    deploy_model.eval()
+    imgs = torch.randn(16, 3, 32, 32)
+    with torch.no_grad():
+        out = model(imgs)
+        out_deploy = deploy_model(imgs)
+    assert not model.stage0.deploy, "====> save_deploy changed the model "
+    assert torch.allclose(out, out_deploy, atol=1e-4), "====> deploy error "
+
+
 if __name__ == '__main__':
     test_repvgg()
+    test_repvgg_switch_to_deploy()
+    test_repvgg_inplace_add_backward()
+    test_repvgg_eval_fold_refresh()
+    test_repvgg_compile()
+    test_repvgg_amp_bfloat16()
+    test_repvgg_pack_stages()
+    test_repvgg_quantize_int8()
+    if torch.cuda.is_available():
+        test_repvgg_capture_graph()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_repvgg_save_deploy(Path(tmp_dir))